@@ -1,8 +1,10 @@
 import json
+import mmap
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from threading import RLock
-from typing import BinaryIO, Sequence, overload, Union, Optional
+from threading import Lock
+from typing import BinaryIO, Sequence, overload, Union, Optional, List
 
 import numpy as np
 
@@ -50,17 +52,15 @@ class DataFileInfo:
 
 
 class DataFile:
-    def __init__(self, info: DataFileInfo, bin_handle: BinaryIO, off_handle: BinaryIO):
+    def __init__(self, info: DataFileInfo, bin_data: 'RandomAccessData', off_data: 'RandomAccessData'):
         assert isinstance(info, DataFileInfo)
 
         self.info = info
         self.simulations = FileSimulationsView(self, range(self.info.simulation_count))
         self.positions = FilePositionsView(self, range(self.info.position_count))
 
-        # this lock is specifically for seeking in both handles
-        self.lock = RLock()
-        self.bin_handle = bin_handle
-        self.off_handle = off_handle
+        self.bin_data = bin_data
+        self.off_data = off_data
 
         self._cached_simulation_start_indices = None
 
@@ -71,6 +71,11 @@ class DataFile:
         bin_path = path.with_suffix(".bin").absolute()
         off_path = path.with_suffix(".off").absolute()
 
+        # fall back to the compressed data file if there is no uncompressed one
+        bin_gz_path = bin_path.with_name(bin_path.name + ".gz")
+        if not bin_path.exists() and bin_gz_path.exists():
+            bin_path = bin_gz_path
+
         for p in [json_path, off_path, bin_path]:
             if not p.exists():
                 raise FileNotFoundError(f"{p} does not exist")
@@ -79,15 +84,13 @@ class DataFile:
             meta = json.loads(json_f.read())
         timestamp = os.path.getmtime(json_path)
 
-        bin_handle = random_access_handle(bin_path)
-
-        # for large datasets even the offsets don't fit into RAM, so we're reading them from disk as we need them
-        off_handle = random_access_handle(off_path)
-        off_handle.seek(0, os.SEEK_END)
-        off_len_bytes = off_handle.tell()
+        # the data files are mapped instead of read, so opening is cheap and only the pages we touch are loaded
+        #   (for large datasets even the offsets don't fit into RAM)
+        bin_data = random_access_data(bin_path)
+        off_data = random_access_data(off_path)
 
-        bin_handle.seek(0, os.SEEK_END)
-        final_offset = bin_handle.tell()
+        off_len_bytes = len(off_data)
+        final_offset = len(bin_data)
 
         info = DataFileInfo(game, meta, bin_path, off_path, final_offset, timestamp)
 
@@ -97,32 +100,43 @@ class DataFile:
             expected_off_len_bytes = OFFSET_SIZE_IN_BYTES * info.position_count
         assert expected_off_len_bytes == off_len_bytes, f"Mismatch in offset size, expected {expected_off_len_bytes} but got {off_len_bytes}"
 
-        return DataFile(info, bin_handle, off_handle)
+        return DataFile(info, bin_data, off_data)
+
+    @staticmethod
+    def open_many(game: Optional[Game], paths: Sequence[str], threads: int = 16) -> List['DataFile']:
+        """ Open all files in parallel, opening is mostly waiting on the filesystem. Keeps the order of `paths`. """
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            return list(executor.map(lambda p: DataFile.open(game, p), paths))
+
+    @staticmethod
+    def _reopen(info: DataFileInfo) -> 'DataFile':
+        return DataFile(
+            info,
+            random_access_data(info.bin_path),
+            random_access_data(info.off_path),
+        )
 
     def with_new_handles(self) -> 'DataFile':
         # TODO do we actually need any of this?
         #   typically we're sampling from many files at once so there shouldn't be too much locking
-        return DataFile(
-            self.info,
-            random_access_handle(self.info.bin_path),
-            random_access_handle(self.info.off_path),
-        )
+        return DataFile._reopen(self.info)
 
-    def load_position(self, pi: int) -> Position:
-        with self.lock:
-            self.off_handle.seek(pi * OFFSET_SIZE_IN_BYTES)
+    def __reduce__(self):
+        # the mappings themselves can't be pickled, so sending a file to a worker process reopens it there instead
+        return DataFile._reopen, (self.info,)
 
-            if pi == self.info.position_count - 1:
-                off_bytes = self.off_handle.read(OFFSET_SIZE_IN_BYTES)
-                start_offset = int.from_bytes(off_bytes, "little")
-                end_offset = self.info.final_offset
-            else:
-                off_bytes = self.off_handle.read(2 * OFFSET_SIZE_IN_BYTES)
-                start_offset = int.from_bytes(off_bytes[:OFFSET_SIZE_IN_BYTES], "little")
-                end_offset = int.from_bytes(off_bytes[OFFSET_SIZE_IN_BYTES:], "little")
+    def _load_offset(self, i: int) -> int:
+        off_bytes = self.off_data[i * OFFSET_SIZE_IN_BYTES:(i + 1) * OFFSET_SIZE_IN_BYTES]
+        return int.from_bytes(off_bytes, "little")
+
+    def load_position(self, pi: int) -> Position:
+        start_offset = self._load_offset(pi)
+        if pi == self.info.position_count - 1:
+            end_offset = self.info.final_offset
+        else:
+            end_offset = self._load_offset(pi + 1)
 
-            self.bin_handle.seek(start_offset)
-            data = self.bin_handle.read(end_offset - start_offset)
+        data = self.bin_data[start_offset:end_offset]
 
         return Position(
             game=self.info.game,
@@ -136,27 +150,22 @@ class DataFile:
     def load_simulation(self, si: int) -> Simulation:
         is_final_simulation = si == self.info.simulation_count - 1
 
-        with self.lock:
-            if self.info.includes_simulation_start_indices:
-                self.off_handle.seek((self.info.position_count + si) * OFFSET_SIZE_IN_BYTES)
-
-                if is_final_simulation:
-                    index_bytes = self.off_handle.read(OFFSET_SIZE_IN_BYTES)
-                    start_pi = int.from_bytes(index_bytes, "little")
-                    end_pi = self.info.position_count - 1
-                else:
-                    index_bytes = self.off_handle.read(OFFSET_SIZE_IN_BYTES * 2)
-                    start_pi = int.from_bytes(index_bytes[:OFFSET_SIZE_IN_BYTES], "little")
-                    end_pi = int.from_bytes(index_bytes[OFFSET_SIZE_IN_BYTES:], "little") - 1
+        if self.info.includes_simulation_start_indices:
+            start_pi = self._load_offset(self.info.position_count + si)
+
+            if is_final_simulation:
+                end_pi = self.info.position_count - 1
             else:
-                start_indices = self._simulation_start_indices()
+                end_pi = self._load_offset(self.info.position_count + si + 1) - 1
+        else:
+            start_indices = self._simulation_start_indices()
 
-                start_pi = start_indices[si]
+            start_pi = start_indices[si]
 
-                if is_final_simulation:
-                    end_pi = self.info.position_count - 1
-                else:
-                    end_pi = start_indices[si + 1] - 1
+            if is_final_simulation:
+                end_pi = self.info.position_count - 1
+            else:
+                end_pi = start_indices[si + 1] - 1
 
         return Simulation(
             index=si,
@@ -188,8 +197,8 @@ class DataFile:
         return starts
 
     def close(self):
-        self.bin_handle.close()
-        self.off_handle.close()
+        self.bin_data.close()
+        self.off_data.close()
 
 
 class FileSimulationsView(Sequence[Simulation]):
@@ -267,5 +276,65 @@ class FilePositionsView(Sequence[Position]):
         return FilePositionsView(self.file.with_new_handles(), self.pi_range)
 
 
-def random_access_handle(path: Path) -> BinaryIO:
-    return open(path, "rb", buffering=0)
+RandomAccessData = Union[mmap.mmap, 'HandleData']
+
+
+def random_access_data(path: Path) -> RandomAccessData:
+    if path.suffix == ".gz":
+        return HandleData(gzip_random_access_handle(path))
+
+    # uncompressed files are memory mapped, so the pages are shared through the OS page cache
+    with open(path, "rb") as f:
+        # empty files can't be mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            return HandleData(open(path, "rb", buffering=0))
+
+        # the mapping stays valid after the file itself is closed
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class HandleData:
+    """ Sliceable wrapper around a seekable handle, for files that can't be memory mapped. """
+
+    def __init__(self, handle: BinaryIO):
+        self.handle = handle
+        # this lock is specifically for seeking in the handle
+        self.lock = Lock()
+
+    def __len__(self):
+        with self.lock:
+            self.handle.seek(0, os.SEEK_END)
+            return self.handle.tell()
+
+    def __getitem__(self, item: slice) -> bytes:
+        assert isinstance(item, slice) and item.step is None, f"Only contiguous slices are supported, got {item}"
+
+        with self.lock:
+            self.handle.seek(item.start)
+            return self.handle.read(item.stop - item.start)
+
+    def close(self):
+        self.handle.close()
+
+
+def gzip_random_access_handle(path: Path) -> BinaryIO:
+    # optional dependency, only required when actually reading compressed files
+    import rapidgzip
+
+    # store the seek points next to the file, so only the first open has to decompress everything
+    index_path = path.with_suffix("").with_suffix(".idx")
+    # there are many handles and only small random reads, a decoder thread pool per handle isn't worth it
+    handle = rapidgzip.open(str(path), parallelization=1)
+
+    if index_path.exists():
+        handle.import_index(str(index_path))
+    else:
+        # seeking to the end builds the full index
+        handle.seek(0, os.SEEK_END)
+        handle.seek(0)
+
+        tmp_index_path = index_path.with_suffix(".idx.tmp")
+        handle.export_index(str(tmp_index_path))
+        os.replace(tmp_index_path, index_path)
+
+    return handle
@@ -1,3 +1,4 @@
+import math
 import random
 from dataclasses import dataclass
 from typing import List, Optional
@@ -7,7 +8,7 @@ import torch
 
 from lib.data.taker import Taker
 from lib.games import Game
-from lib.util import DEVICE, prod, map_none, map_none_or
+from lib.util import DEVICE, map_none, map_none_or
 
 
 @dataclass
@@ -91,7 +92,7 @@ class Position:
         if len(scalars):
             print(f"Leftover scalars: {list(scalars.keys())}")
 
-        bool_count = prod(game.input_bool_shape)
+        bool_count = math.prod(game.input_bool_shape)
         bit_buffer = np.frombuffer(data.take((bool_count + 7) // 8), dtype=np.uint8)
         bool_buffer = np.unpackbits(bit_buffer, bitorder="little")
         self.input_bools = bool_buffer[:bool_count].reshape(*game.input_bool_shape)
@@ -161,10 +162,19 @@ class PostFinalPosition:
 
 
 class PositionBatch:
-    def __init__(self, game: Game, positions: List[Position], include_final_for_each: bool, pin_memory: bool):
+    def __init__(
+            self,
+            game: Game, positions: List[Position], include_final_for_each: bool,
+            pin_memory: bool, device=DEVICE, input_full: Optional[torch.Tensor] = None
+    ):
+        """ `input_full` is an optional preallocated tensor to write the inputs into. """
+
         self.max_available_moves = max(p.available_mv_count if p is not None else 0 for p in positions)
 
-        input_full = torch.empty(len(positions), *game.full_input_shape, pin_memory=pin_memory)
+        if input_full is None:
+            input_full = torch.empty(len(positions), *game.full_input_shape, pin_memory=pin_memory)
+        else:
+            assert input_full.shape == (len(positions), *game.full_input_shape)
         all_wdls = torch.empty(len(positions), 3 * 3, pin_memory=pin_memory)
         all_values = torch.empty(len(positions), 3, pin_memory=pin_memory)
         all_moves_left = torch.empty(len(positions), 3, pin_memory=pin_memory)
@@ -230,25 +240,53 @@ class PositionBatch:
             is_final[i] = p.is_final
             is_post_final[i] = p.is_post_final
 
-        self.input_full = input_full.to(DEVICE)
-        self.final_input_full = final_input_full.to(DEVICE) if include_final_for_each else None
+        self.input_full = input_full
+        self.final_input_full = final_input_full
+
+        self.policy_indices = policy_indices
+        self.policy_values = policy_values
+
+        self.played_mv = played_mv
+        self.move_index = move_index
+        self.file_pi = file_pi
+        self.sim_index = sim_index
+        self.played_mv_full = played_mv_full
+
+        self.is_terminal = is_terminal
+        self.is_final = is_final
+        self.is_post_final = is_post_final
 
-        self.policy_indices = policy_indices.to(DEVICE)
-        self.policy_values = policy_values.to(DEVICE)
+        self.all_wdls = all_wdls
+        self.all_values = all_values
+        self.all_moves_left = all_moves_left
 
-        self.played_mv = played_mv.to(DEVICE)
-        self.move_index = move_index.to(DEVICE)
-        self.file_pi = file_pi.to(DEVICE)
-        self.sim_index = sim_index.to(DEVICE)
-        self.played_mv_full = played_mv_full.to(DEVICE) if played_mv_full is not None else None
+        self.to(device)
 
-        self.is_terminal = is_terminal.to(DEVICE)
-        self.is_final = is_final.to(DEVICE)
-        self.is_post_final = is_post_final.to(DEVICE)
+    def to(self, device, copy: bool = False, non_blocking: bool = False) -> 'PositionBatch':
+        """ Move all tensors to the given device, in place. `copy` copies even if they're already on that device. """
 
-        self.all_wdls = all_wdls.to(DEVICE)
-        self.all_values = all_values.to(DEVICE)
-        self.all_moves_left = all_moves_left.to(DEVICE)
+        def move(x):
+            return x.to(device, copy=copy, non_blocking=non_blocking)
+
+        self.input_full = move(self.input_full)
+        self.final_input_full = map_none(self.final_input_full, move)
+
+        self.policy_indices = move(self.policy_indices)
+        self.policy_values = move(self.policy_values)
+
+        self.played_mv = move(self.played_mv)
+        self.move_index = move(self.move_index)
+        self.file_pi = move(self.file_pi)
+        self.sim_index = move(self.sim_index)
+        self.played_mv_full = map_none(self.played_mv_full, move)
+
+        self.is_terminal = move(self.is_terminal)
+        self.is_final = move(self.is_final)
+        self.is_post_final = move(self.is_post_final)
+
+        self.all_wdls = move(self.all_wdls)
+        self.all_values = move(self.all_values)
+        self.all_moves_left = move(self.all_moves_left)
 
         self.wdl_final = self.all_wdls[:, 0:3]
         self.wdl_zero = self.all_wdls[:, 3:6]
@@ -260,6 +298,14 @@ class PositionBatch:
         self.moves_left_zero = self.all_moves_left[:, 1]
         self.moves_left_net = self.all_moves_left[:, 2]
 
+        return self
+
+    def record_stream(self, stream: torch.cuda.Stream):
+        """ Mark all device tensors as used by `stream`, see `torch.Tensor.record_stream`. """
+        for value in vars(self).values():
+            if isinstance(value, torch.Tensor) and value.is_cuda:
+                value.record_stream(stream)
+
     def __len__(self):
         return len(self.input_full)
 
@@ -279,8 +325,10 @@ class UnrolledPositionBatch:
             include_final_for_each: bool,
             batch_size: int,
             chains: List[List[Position]],
-            pin_memory: bool
+            pin_memory: bool, device=DEVICE, input_full: Optional[torch.Tensor] = None
     ):
+        """ `input_full` is an optional preallocated tensor to write the inputs into, with a leading step axis. """
+
         assert unroll_steps >= 0, "Negative unroll steps don't make sense"
         for chain in chains:
             assert len(chain) == unroll_steps + 1, f"Expected {unroll_steps + 1} positions, got chain with {len(chain)}"
@@ -301,9 +349,22 @@ class UnrolledPositionBatch:
         self.unroll_steps = unroll_steps
         self.batch_size = batch_size
         self.positions = [
-            PositionBatch(game, positions, include_final_for_each, pin_memory)
-            for positions in positions_by_step
+            PositionBatch(
+                game, positions, include_final_for_each, pin_memory, device,
+                input_full[si] if input_full is not None else None
+            )
+            for si, positions in enumerate(positions_by_step)
         ]
 
+    def to(self, device, copy: bool = False, non_blocking: bool = False) -> 'UnrolledPositionBatch':
+        """ Move all tensors to the given device, in place. """
+        for p in self.positions:
+            p.to(device, copy, non_blocking)
+        return self
+
+    def record_stream(self, stream: torch.cuda.Stream):
+        for p in self.positions:
+            p.record_stream(stream)
+
     def __len__(self):
         return self.batch_size
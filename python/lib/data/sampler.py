@@ -1,11 +1,17 @@
+import math
+import queue
 import random
 from threading import Thread
 from typing import Optional, Union
 
+import torch
+from torch import multiprocessing
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
+
 from lib.data.group import DataGroup
 from lib.data.position import PositionBatch, UnrolledPositionBatch, Position
 from lib.queue import CQueue, CQueueClosed
-from lib.util import PIN_MEMORY
+from lib.util import PIN_MEMORY, DEVICE
 
 
 class PositionSampler:
@@ -18,8 +24,13 @@ class PositionSampler:
             include_final_for_each: bool,
             random_symmetries: bool,
             threads: int,
+            processes: int = 0,
+            prefetch_factor: Optional[int] = None,
     ):
+        # collecting batches is mostly python code, so threads end up serialized on the GIL, processes don't
         self.group = group
+        # incremented for each group update, batches sampled from an older group are dropped
+        self.version = 0
 
         if random_symmetries:
             assert unroll_steps is None, "Random symmetries not yet supported for unrolled sampling"
@@ -30,17 +41,66 @@ class PositionSampler:
         self.include_final_for_each = include_final_for_each
         self.random_symmetries = random_symmetries
 
-        self.queue = CQueue(threads + 1)
+        if processes > 0:
+            if unroll_steps is None:
+                input_shape = (batch_size, *group.game.full_input_shape)
+            else:
+                input_shape = (unroll_steps + 1, batch_size, *group.game.full_input_shape)
+
+            # by default, prefetch as many batches as fit in the shared memory budget
+            if prefetch_factor is None:
+                prefetch_factor = default_prefetch_factor(processes, input_shape)
+
+            # every worker can have prefetch_factor batches in flight, plus one batch being consumed
+            self.ring = SharedBatchRing(processes * prefetch_factor + 1, input_shape)
+            self.group_queues = [multiprocessing.Queue() for _ in range(processes)]
+
+            self.dataset = PositionDataset(self)
+            loader = DataLoader(
+                self.dataset,
+                batch_size=None,
+                num_workers=processes,
+                persistent_workers=True,
+                prefetch_factor=prefetch_factor,
+            )
+
+            # a single thread copies finished batches to the device, overlapping with the training step
+            self.queue = CQueue(1)
+            self.threads = [Thread(target=transfer_main, args=(self, iter(loader)), daemon=True)]
+        else:
+            self.ring = None
+            self.group_queues = []
+            self.dataset = PositionDataset(self)
+
+            if prefetch_factor is None:
+                prefetch_factor = 2
+
+            self.queue = CQueue(threads * prefetch_factor)
+            self.threads = [
+                Thread(target=thread_main, args=(self,), daemon=True)
+                for _ in range(threads)
+            ]
 
-        self.threads = [
-            Thread(target=thread_main, args=(self,), daemon=True)
-            for _ in range(threads)
-        ]
         for thread in self.threads:
             thread.start()
 
     def close(self):
+        # this also stops the transfer thread, which then drops the loader iterator and shuts down the worker processes
         self.queue.close()
+        # wait for that to finish, otherwise the workers get killed at exit while the transfer thread is still reading
+        for thread in self.threads:
+            thread.join()
+
+    def update_group(self, group: DataGroup):
+        assert group.game == self.group.game
+
+        # set the group before bumping the version, so threads never tag batches from the old group as current
+        self.group = group
+        self.dataset.group = group
+        self.version += 1
+
+        for group_queue in self.group_queues:
+            group_queue.put((self.version, group))
 
     def next_batch_either(self) -> Union[PositionBatch, UnrolledPositionBatch]:
         if self.unroll_steps is None:
@@ -50,50 +110,169 @@ class PositionSampler:
 
     def next_batch(self) -> PositionBatch:
         assert self.unroll_steps is None, "This sampler does not sample simple batches"
-        return self.queue.pop_blocking()
+        return self._pop_batch()
 
     def next_unrolled_batch(self) -> UnrolledPositionBatch:
         assert self.unroll_steps is not None, "This sampler does not sample unrolled batches"
-        return self.queue.pop_blocking()
+        return self._pop_batch()
+
+    def _pop_batch(self):
+        while True:
+            version, batch = self.queue.pop_blocking()
+            if version == self.version:
+                return batch
+
+
+# the shared memory budget for the inputs of prefetched batches
+PREFETCH_MEMORY_BUDGET = 1024 * 1024 * 1024
+
+
+def default_prefetch_factor(processes: int, input_shape) -> int:
+    batch_bytes = 4 * math.prod(input_shape)
+    return max(2, min(8, PREFETCH_MEMORY_BUDGET // (processes * batch_bytes)))
+
+
+# shared memory slots the worker processes write the batch inputs into, so only the slot index has to be sent back
+class SharedBatchRing:
+    def __init__(self, slots: int, shape):
+        self.buffers = torch.empty(slots, *shape).share_memory_()
+
+        self.free_slots = multiprocessing.Queue()
+        for slot in range(slots):
+            self.free_slots.put(slot)
+
+    def acquire(self) -> int:
+        return self.free_slots.get()
+
+    def release(self, slot: int):
+        self.free_slots.put(slot)
+
+
+# the sampling settings without any of the threading state, so this can be sent to the worker processes
+class PositionDataset(IterableDataset):
+    def __init__(self, sampler: PositionSampler):
+        self.group = sampler.group
+        self.version = sampler.version
+        self.ring = sampler.ring
+        self.group_queues = sampler.group_queues
+
+        self.batch_size = sampler.batch_size
+        self.unroll_steps = sampler.unroll_steps
+        self.include_final = sampler.include_final
+        self.include_final_for_each = sampler.include_final_for_each
+        self.random_symmetries = sampler.random_symmetries
+
+    def __iter__(self):
+        group_queue = self.group_queues[get_worker_info().id]
+
+        # the dataset was unpickled in this worker, so this group already has its own mappings of the files
+        version = self.version
+        group = self.group
+
+        try:
+            while True:
+                # switch to the most recent group, if any, unpickling it already reopened the files
+                try:
+                    while True:
+                        version, new_group = group_queue.get_nowait()
+                        group.close()
+                        group = new_group
+                except queue.Empty:
+                    pass
+
+                slot = self.ring.acquire()
+                # pinning memory would initialize cuda in the worker, the main process copies out of the slot anyway
+                yield version, slot, collect_batch(self, group, False, self.ring.buffers[slot])
+        finally:
+            group.close()
 
 
 def thread_main(sampler: PositionSampler):
-    group = sampler.group.with_new_handles()
-    unroll_steps = sampler.unroll_steps
+    stream = torch.cuda.Stream() if DEVICE.type == "cuda" else None
 
     try:
         while True:
-            if unroll_steps is None:
-                sampler.queue.push_blocking(collect_simple_batch(sampler, group))
-            else:
-                sampler.queue.push_blocking(collect_unrolled_batch(sampler, group, unroll_steps))
+            # all threads share the group, reads from the mapped files don't have any seek state
+            #   (read the version first, so a batch is never tagged with a newer version than its group)
+            version = sampler.version
+            group = sampler.group
+
+            batch = collect_batch(sampler.dataset, group, PIN_MEMORY)
+            copy_to_device(batch, stream, copy=False)
+            sampler.queue.push_blocking((version, batch))
 
     except CQueueClosed:
-        group.close()
+        pass
+
+
+def transfer_main(sampler: PositionSampler, loader_iter):
+    stream = torch.cuda.Stream() if DEVICE.type == "cuda" else None
+
+    try:
+        while True:
+            version, slot, batch = next(loader_iter)
+
+            # drop stale batches before copying them to the device
+            if version != sampler.version:
+                sampler.ring.release(slot)
+                continue
+
+            # copy the inputs out of the shared slot before handing it back to the workers
+            copy_to_device(batch, stream, copy=True)
+            sampler.ring.release(slot)
+
+            sampler.queue.push_blocking((version, batch))
+
+    except CQueueClosed:
+        pass
+
+
+def copy_to_device(batch: Union[PositionBatch, UnrolledPositionBatch], stream: Optional[torch.cuda.Stream], copy: bool):
+    # copy on a side stream, so the copy doesn't wait for the training kernels queued on the default stream
+    if stream is None:
+        batch.to(DEVICE, copy=copy)
+    else:
+        with torch.cuda.stream(stream):
+            batch.to(DEVICE, copy=copy, non_blocking=True)
+        stream.synchronize()
+
+        # the tensors were allocated on the side stream but are used by the training thread on the default stream,
+        #   tell the allocator so it doesn't reuse the memory while training kernels may still be reading it
+        batch.record_stream(torch.cuda.default_stream(stream.device))
+
+
+def collect_batch(dataset: PositionDataset, group: DataGroup, pin_memory: bool, input_full=None):
+    """ Collect a batch on the cpu. """
+    if dataset.unroll_steps is None:
+        return collect_simple_batch(dataset, group, pin_memory, input_full)
+    else:
+        return collect_unrolled_batch(dataset, group, dataset.unroll_steps, pin_memory, input_full)
 
 
-def collect_simple_batch(sampler: PositionSampler, group: DataGroup):
+def collect_simple_batch(dataset: PositionDataset, group: DataGroup, pin_memory: bool, input_full):
     positions = []
 
-    for _ in range(sampler.batch_size):
-        _, p = sample_position(group, sampler.include_final, sampler.include_final_for_each)
+    for _ in range(dataset.batch_size):
+        _, p = sample_position(group, dataset.include_final, dataset.include_final_for_each)
 
-        if sampler.random_symmetries:
+        if dataset.random_symmetries:
             index = random.randrange(len(p.game.symmetry))
             p.map_symmetry_inplace(index)
 
         positions.append(p)
 
-    return PositionBatch(group.game, positions, sampler.include_final_for_each, PIN_MEMORY)
+    return PositionBatch(group.game, positions, dataset.include_final_for_each, pin_memory, "cpu", input_full)
 
 
-def collect_unrolled_batch(sampler: PositionSampler, group: DataGroup, unroll_steps: int):
-    assert not sampler.random_symmetries
+def collect_unrolled_batch(
+        dataset: PositionDataset, group: DataGroup, unroll_steps: int, pin_memory: bool, input_full
+):
+    assert not dataset.random_symmetries
 
     chains = []
 
-    for _ in range(sampler.batch_size):
-        (first_pi, first_position) = sample_position(group, sampler.include_final, sampler.include_final_for_each)
+    for _ in range(dataset.batch_size):
+        (first_pi, first_position) = sample_position(group, dataset.include_final, dataset.include_final_for_each)
         chain = [first_position]
 
         for ri in range(unroll_steps):
@@ -112,7 +291,7 @@ def collect_unrolled_batch(sampler: PositionSampler, group: DataGroup, unroll_st
             if position.simulation.index != first_position.simulation.index:
                 break
             # maybe we don't want the final position
-            if position.is_final and not sampler.include_final:
+            if position.is_final and not dataset.include_final:
                 break
 
             # finally we can include the position
@@ -126,8 +305,8 @@ def collect_unrolled_batch(sampler: PositionSampler, group: DataGroup, unroll_st
 
     return UnrolledPositionBatch(
         group.game,
-        unroll_steps, sampler.include_final_for_each, sampler.batch_size,
-        chains, PIN_MEMORY
+        unroll_steps, dataset.include_final_for_each, dataset.batch_size,
+        chains, pin_memory, "cpu", input_full
     )
 
 
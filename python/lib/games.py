@@ -1,13 +1,13 @@
+import math
 import re
 from abc import abstractmethod, ABC
 from dataclasses import dataclass, field
-from typing import Tuple, Optional, Callable, Sequence
+from typing import Tuple, Optional, Callable, Sequence, Dict
 
 import numpy as np
 
 from lib.mapping.mapping import CHESS_FLAT_TO_MOVE_INPUT, ATAXX_VALID_MOVES, ATAXX_INDEX_TO_MOVE_INPUT, \
     get_ataxx_symmetry_data
-from lib.util import prod
 
 
 class Symmetry(ABC):
@@ -24,7 +24,16 @@ class Symmetry(ABC):
         pass
 
 
-@dataclass
+# games are interned by name (see `find` and `__reduce__`), so equality can just be identity
+_SHAPES: Dict[Tuple[int, ...], Tuple[int, ...]] = {}
+
+
+def intern_shape(shape: Tuple[int, ...]) -> Tuple[int, ...]:
+    """ Equal shapes share a single tuple instance, so comparing them mostly hits the identity fast path. """
+    return _SHAPES.setdefault(shape, shape)
+
+
+@dataclass(eq=False)
 class Game:
     name: str
 
@@ -52,18 +61,20 @@ class Game:
     symmetry: Symmetry
 
     def __post_init__(self):
-        self.input_bool_shape = (self.input_bool_channels, self.board_size, self.board_size)
-        self.input_scalar_shape = (self.input_scalar_channels, self.board_size, self.board_size)
+        self.input_bool_shape = intern_shape((self.input_bool_channels, self.board_size, self.board_size))
+        self.input_scalar_shape = intern_shape((self.input_scalar_channels, self.board_size, self.board_size))
 
         self.full_input_channels = self.input_bool_channels + self.input_scalar_channels
-        self.full_input_shape = (self.full_input_channels, self.board_size, self.board_size)
+        self.full_input_shape = intern_shape((self.full_input_channels, self.board_size, self.board_size))
 
         if self.input_mv_channels is not None:
-            self.input_mv_shape = (self.input_mv_channels, self.board_size, self.board_size)
+            self.input_mv_shape = intern_shape((self.input_mv_channels, self.board_size, self.board_size))
         else:
             self.input_mv_shape = None
 
-        self.policy_size = prod(self.policy_shape)
+        self.policy_shape = intern_shape(tuple(self.policy_shape))
+
+        self.policy_size = math.prod(self.policy_shape)
 
     @classmethod
     def find(cls, name: str):
@@ -93,6 +104,10 @@ class Game:
         assert game.name == name
         return game
 
+    def __reduce__(self):
+        # games contain lambdas, so pickle them by name instead
+        return Game.find, (self.name,)
+
 
 class UnitSymmetry(Symmetry):
     def __len__(self) -> int:
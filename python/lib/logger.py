@@ -1,9 +1,11 @@
+import json
 import os
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Tuple, Dict
+from typing import Tuple, Dict, Optional
 
 import numpy as np
+from numpy.lib.format import open_memmap
 
 from lib.growable_array import GrowableArray
 
@@ -21,10 +23,15 @@ class Logger:
         self.curr_batch = -1
         self.data: Dict[Key, GrowableArray] = {}
 
+        # state for incremental saving
+        self._save_path: Optional[Path] = None
+        self._save_array: Optional[np.memmap] = None
+        self._saved_batches = 0
+
     def start_batch(self):
         self.curr_batch += 1
         for a in self.data.values():
-            a.append(np.NaN)
+            a.append(np.nan)
 
     def log(self, group: str, name: str, value):
         assert self.curr_batch >= 0, "No batch has been started yet"
@@ -33,12 +40,21 @@ class Logger:
         if key in self.data:
             a = self.data[key]
         else:
-            a = GrowableArray(initial_values=np.full(self.curr_batch + 1, np.NaN))
+            a = GrowableArray(initial_values=np.full(self.curr_batch + 1, np.nan))
             self.data[key] = a
 
         assert np.isnan(a[self.curr_batch]), f"Key {key} was already logged during this batch"
         a[self.curr_batch] = value
 
+    def truncate(self, batches: int):
+        """ Drop everything logged from batch `batches` onwards. """
+        self.curr_batch = min(self.curr_batch, batches - 1)
+        for a in self.data.values():
+            a.truncate(self.curr_batch + 1)
+
+        # the dropped rows will be overwritten by the next incremental save
+        self._saved_batches = min(self._saved_batches, max(self.curr_batch, 0))
+
     def finished_data(self) -> LoggerData:
         return LoggerData(
             axis=np.arange(self.curr_batch),
@@ -46,8 +62,13 @@ class Logger:
         )
 
     def save(self, path: str):
+        # .npy files only write the batches that changed since the previous save, .npz files rewrite everything
         path = Path(path)
-        assert path.suffix == ".npz", f"Log save path should have extension .npz, got {path}"
+        if path.suffix == ".npy":
+            self._save_incremental(path)
+            return
+
+        assert path.suffix == ".npz", f"Log save path should have extension .npz or .npy, got {path}"
 
         data = {
             "curr_batch": self.curr_batch,
@@ -59,15 +80,97 @@ class Logger:
         np.savez(tmp_path, **data)
         os.replace(tmp_path, path)
 
+    def _save_incremental(self, path: Path):
+        # the values go into a mapped column-major array with a column per key, the keys into a json file next to it
+        keys = list(self.data.keys())
+        rows = self.curr_batch + 1
+
+        if self._save_path != path:
+            self._save_path = path
+            self._save_array = None
+            self._saved_batches = 0
+
+        # continue writing into the file we were loaded from
+        if self._save_array is None and self._saved_batches > 0:
+            self._save_array = open_memmap(path, mode="r+")
+
+        array = self._save_array
+        if array is None or array.shape[0] < rows or array.shape[1] < len(keys):
+            # close the old mapping first, otherwise we can't replace the file on windows
+            self._save_array = None
+            array = None
+
+            # double the capacity, so the array only has to be rewritten rarely
+            tmp_path = path.with_suffix(".tmp.npy")
+            shape = (max(1024, 2 * rows), max(64, 2 * len(keys)))
+            new_array = open_memmap(tmp_path, mode="w+", dtype=np.float64, shape=shape, fortran_order=True)
+            new_array[:] = np.nan
+            new_array.flush()
+            del new_array
+
+            os.replace(tmp_path, path)
+            array = open_memmap(path, mode="r+")
+            self._save_array = array
+            self._saved_batches = 0
+
+        start = self._saved_batches
+        for ki, key in enumerate(keys):
+            array[start:rows, ki] = self.data[key].values[start:rows]
+        array.flush()
+
+        meta = {
+            "curr_batch": self.curr_batch,
+            "keys": keys,
+        }
+        meta_path = path.with_suffix(".json")
+        tmp_meta_path = path.with_suffix(".tmp.json")
+        with open(tmp_meta_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_meta_path, meta_path)
+
+        # the current batch can still get more values, so it has to be written again next time
+        self._saved_batches = max(self.curr_batch, 0)
+
     @staticmethod
     def load(path) -> 'Logger':
+        path = Path(path)
+        if path.suffix == ".npy":
+            # runs started before incremental log saving still have a full .npz log
+            if not path.exists() and path.with_suffix(".npz").exists():
+                return Logger.load(path.with_suffix(".npz"))
+            return Logger._load_incremental(path)
+
         data = np.load(path)
 
         result = Logger()
-        result.curr_batch = data["curr_batch"]
+        result.curr_batch = int(data["curr_batch"])
         result.data = {
             tuple(k): GrowableArray(v)
             for k, v in zip(data["keys"], data["values"])
         }
 
         return result
+
+    @staticmethod
+    def _load_incremental(path: Path) -> 'Logger':
+        with open(path.with_suffix(".json"), "r") as f:
+            meta = json.load(f)
+
+        curr_batch = meta["curr_batch"]
+        rows = curr_batch + 1
+
+        # map copy-on-write so nothing is read until it's used and in-place changes never reach the file,
+        #   the columns are contiguous so these are all just views
+        array = np.load(path, mmap_mode="c")
+
+        result = Logger()
+        result.curr_batch = curr_batch
+        result.data = {
+            tuple(k): GrowableArray(array[:rows, ki])
+            for ki, k in enumerate(meta["keys"])
+        }
+
+        result._save_path = path
+        result._saved_batches = max(curr_batch, 0)
+
+        return result
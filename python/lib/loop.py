@@ -1,11 +1,17 @@
+import copy
+import functools
+import hashlib
 import itertools
 import json
 import os
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Callable, Optional, Tuple, Iterator, List
+from typing import Callable, Optional, Tuple, Iterator, List, Deque, Dict
 
+import numpy as np
 import torch
 from torch import nn
 from torch.optim import Optimizer
@@ -15,8 +21,9 @@ from lib.data.group import DataGroup
 from lib.data.sampler import PositionSampler
 from lib.games import Game
 from lib.logger import Logger
+from lib.networks import compile_network
 from lib.plotter import LogPlotter, run_with_plotter
-from lib.save_onnx import save_onnx, save_muzero_onnx
+from lib.save_onnx import save_onnx, save_muzero_onnx, MUZERO_ONNX_SUFFIXES
 from lib.selfplay_client import SelfplaySettings, StartupSettings, SelfplayClient
 from lib.train import TrainSettings
 from lib.util import DEVICE, print_param_count, clean_folder, stochastic_round, json_map
@@ -60,7 +67,8 @@ class FixedSelfplaySettings:
         )
 
 
-@dataclass
+# hashed by identity so generations can be cached per settings instance
+@dataclass(eq=False)
 class LoopSettings:
     gui: bool
     root_path: str
@@ -93,6 +101,10 @@ class LoopSettings:
     sample_muzero_steps: Optional[int]
     sample_include_final: bool
     sample_random_symmetries: bool
+    sample_processes: int
+
+    # train with a torch.compile version of the network, the saved networks are still scripted
+    compile_network: bool
 
     muzero: bool = field(init=False)
 
@@ -105,7 +117,7 @@ class LoopSettings:
         self.muzero = self.sample_muzero_steps is not None
         assert self.muzero == self.fixed_settings.muzero, f"Muzero state mismatch, got steps {self.sample_muzero_steps} but fixed settings {self.fixed_settings.muzero}"
 
-        self.log_path = os.path.join(self.root_path, "log.npz")
+        self.log_path = os.path.join(self.root_path, "log.npy")
         self.selfplay_path = os.path.join(self.root_path, "selfplay")
         self.training_path = os.path.join(self.root_path, "training")
         self.tmp_path = os.path.join(self.root_path, "tmp")
@@ -155,14 +167,17 @@ class LoopSettings:
         os.makedirs(self.training_path, exist_ok=True)
         clean_folder(self.tmp_path)
 
-        start_gen, buffer, logger, network = self.load_start_state()
+        start_gen, buffer, logger, network, network_onnx_path = self.load_start_state()
 
         def target(plotter: Optional[LogPlotter]):
             if plotter is not None:
                 plotter.set_title(f"loop: {self.root_path}")
                 plotter.set_can_pause(False)
 
-            self.run_loop_inner(start_gen, buffer, logger, plotter, network)
+            try:
+                self.run_loop_inner(start_gen, buffer, logger, plotter, network, network_onnx_path)
+            finally:
+                buffer.close()
 
         if self.gui:
             run_with_plotter(target)
@@ -173,7 +188,7 @@ class LoopSettings:
             self,
             start_gen: 'Generation', buffer: 'LoopBuffer',
             logger: Logger, plotter: Optional[LogPlotter],
-            network: nn.Module,
+            network: nn.Module, network_onnx_path: Optional[str],
     ):
         print("Saving current settings")
         os.makedirs(start_gen.train_path, exist_ok=True)
@@ -185,6 +200,12 @@ class LoopSettings:
 
         game = self.fixed_settings.game
         optimizer = self.optimizer(network.parameters())
+        if self.compile_network:
+            # the train batch size is fixed, so on cuda the compiled graphs can be captured and replayed as cuda graphs
+            compile_mode = "reduce-overhead" if DEVICE.type == "cuda" else "default"
+            train_network = compile_network(network, mode=compile_mode)
+        else:
+            train_network = network
 
         startup_settings = self.fixed_settings.to_startup(
             output_folder=self.selfplay_path,
@@ -195,11 +216,13 @@ class LoopSettings:
             if self.dummy_network is None:
                 initial_onnx_path = None
             else:
-                dummy_network = torch.jit.script(self.dummy_network())
+                dummy_network = self.dummy_network()
                 print("Dummy network parameters:")
                 print_param_count(dummy_network)
 
                 initial_onnx_path = self.save_tmp_onnx_network(dummy_network, "network_dummy")
+        elif network_onnx_path is not None:
+            initial_onnx_path = network_onnx_path
         else:
             initial_onnx_path = self.save_tmp_onnx_network(network, f"network_{start_gen.gi}")
 
@@ -211,6 +234,10 @@ class LoopSettings:
         else:
             client.send_new_network(initial_onnx_path)
 
+        # the network is saved and exported in the background, overlapping with selfplay for the next gen
+        save_executor = ThreadPoolExecutor(max_workers=1)
+        pending_save: Optional[Future] = None
+
         for gi in itertools.count(start_gen.gi):
             if plotter is not None:
                 plotter.update(logger)
@@ -225,6 +252,11 @@ class LoopSettings:
             logger.log("time", "selfplay", time.perf_counter() - gen_start)
             assert gi == actual_gi, f"Unexpected finished generation, expected {gi} got {actual_gi}"
 
+            # the network and client can only be used again once the previous save has finished
+            if pending_save is not None:
+                pending_save.result()
+                pending_save = None
+
             if self.only_generate:
                 print("Not training new network, we're only generating data")
                 continue
@@ -236,6 +268,8 @@ class LoopSettings:
 
             if buffer.position_count < self.min_buffer_size:
                 print(f"Not training new network yet, only {buffer.position_count}/{self.min_buffer_size} positions")
+                logger.save(self.log_path)
+                Path(gen.finished_path).touch()
             else:
                 if self.wait_for_new_network:
                     client.send_wait_for_new_network()
@@ -260,20 +294,29 @@ class LoopSettings:
                         logger.start_batch()
 
                     train_batch = train_sampler.next_batch_either()
-                    self.train_settings.train_step(train_batch, network, optimizer, logger)
-                train_sampler.close()
+                    self.train_settings.train_step(train_batch, train_network, optimizer, logger)
 
                 logger.log("time", "train", time.perf_counter() - train_start)
 
-                torch.jit.save(network, gen.network_path_pt)
+                # save the log first, the gen is only marked as finished after the network has been saved too
+                logger.save(self.log_path)
+                pending_save = save_executor.submit(self.save_network, client, network, gen)
+
+    def save_network(self, client: SelfplayClient, network: nn.Module, gen: 'Generation'):
+        # remove leftovers from a previous crashed attempt at this gen, the export refuses to overwrite files
+        for path in gen.network_paths_onnx:
+            if os.path.exists(path):
+                os.remove(path)
 
-                curr_onnx_path = self.save_tmp_onnx_network(network, f"network_{gen.gi}")
-                client.send_new_network(curr_onnx_path)
+        onnx_datas = self.save_onnx_network(network, gen.network_path_onnx)
+        client.send_new_network(gen.network_path_onnx)
 
-            logger.save(self.log_path)
-            Path(gen.finished_path).touch()
+        # store the hash of the exported onnx files so a resumed run can reuse them
+        extra_files = {"onnx_sha": hash_onnx_datas(onnx_datas), "game": self.fixed_settings.game.name}
+        torch.jit.save(torch.jit.script(network), gen.network_path_pt, _extra_files=extra_files)
+        Path(gen.finished_path).touch()
 
-    def load_start_state(self) -> Tuple['Generation', 'LoopBuffer', Logger, nn.Module]:
+    def load_start_state(self) -> Tuple['Generation', 'LoopBuffer', Logger, nn.Module, Optional[str]]:
         game = self.fixed_settings.game
         buffer = LoopBuffer(game, self.max_buffer_size, self.test_fraction)
 
@@ -296,13 +339,43 @@ class LoopSettings:
                 if prev is None:
                     print("Starting new run")
                     logger = Logger()
-                    network = torch.jit.script(self.initial_network())
+                    # allocate the parameters on the device directly instead of copying them over afterwards
+                    with torch.device(DEVICE):
+                        network = self.initial_network()
+                    network_onnx_path = None
                 else:
                     print(f"Continuing run, first gen {gi}")
                     logger = Logger.load(self.log_path)
-                    network = torch.jit.load(prev.network_path_pt)
-                network.to(DEVICE)
-                return gen, buffer, logger, network
+
+                    # the log is saved before the network export finishes, so it can already contain batches of
+                    #   this gen even though it was never marked finished, drop them so they're not logged twice
+                    logged_gens = logger.data.get(("info", "gen"))
+                    if logged_gens is not None:
+                        # nan compares false, so batches without a gen are never the start of one
+                        restart = np.flatnonzero(logged_gens.values >= gi)
+                        if len(restart):
+                            logger.truncate(restart[0])
+
+                    extra_files = {"onnx_sha": "", "game": ""}
+                    prev_network = torch.jit.load(prev.network_path_pt, map_location=DEVICE, _extra_files=extra_files)
+
+                    # train the plain module, the scripted one is only used for saving
+                    with torch.device(DEVICE):
+                        network = self.initial_network()
+                    network.load_state_dict(prev_network.state_dict())
+
+                    # reuse the onnx files exported during the previous run if they still match the network
+                    onnx_sha = extra_files["onnx_sha"]
+                    if isinstance(onnx_sha, bytes):
+                        onnx_sha = onnx_sha.decode()
+                    if onnx_sha and all(os.path.exists(p) for p in prev.network_paths_onnx) \
+                            and prev.hash_onnx_files() == onnx_sha:
+                        print(f"Reusing onnx network from gen {prev.gi}")
+                        network_onnx_path = prev.network_path_onnx
+                    else:
+                        network_onnx_path = None
+
+                return gen, buffer, logger, network, network_onnx_path
 
     def evaluate_network(self, buffer: 'LoopBuffer', logger: Logger, network):
         setups = [
@@ -313,8 +386,10 @@ class LoopSettings:
         network.eval()
         for prefix, sampler in setups:
             batch = sampler.next_batch_either()
-            self.train_settings.evaluate_either_batch(batch, network, logger, prefix)
-            sampler.close()
+
+            # no autograd graph is needed for the test batches
+            with torch.inference_mode():
+                self.train_settings.evaluate_either_batch(batch, network, logger, prefix)
 
     def save_tmp_onnx_network(self, network, name: str) -> str:
         curr_folder = os.path.join(self.tmp_path, "curr_network")
@@ -322,19 +397,32 @@ class LoopSettings:
 
         if self.muzero:
             path = os.path.join(curr_folder, f"{name}_")
-            save_muzero_onnx(self.fixed_settings.game, path, network, None)
         else:
             path = os.path.join(curr_folder, f"{name}.onnx")
-            save_onnx(self.fixed_settings.game, path, network, None)
 
+        self.save_onnx_network(network, path)
         return path
 
+    def save_onnx_network(self, network, path: str) -> List[bytes]:
+        """ Returns the contents of the written files, in the same order as `Generation.network_paths_onnx`. """
+
+        # the exporter moves the network to the cpu and back, which would reallocate the parameters of the live network
+        #   and invalidate the cuda graphs captured by the compiled training network, so export a detached copy instead
+        network = copy.deepcopy(network).cpu()
+
+        if self.muzero:
+            return save_muzero_onnx(self.fixed_settings.game, path, network, None)
+        else:
+            return [save_onnx(self.fixed_settings.game, path, network, None)]
+
     def sampler(self, buffer: 'LoopBuffer', only_last_gen: bool, test: bool) -> PositionSampler:
         return buffer.sampler(
             batch_size=self.train_batch_size,
             unroll_steps=self.sample_muzero_steps,
             include_final=self.sample_include_final,
             random_symmetries=self.sample_random_symmetries,
+            # test samplers only produce a single batch, so starting worker processes is not worth it
+            processes=0 if test else self.sample_processes,
             only_last_gen=only_last_gen,
             test=test
         )
@@ -347,10 +435,12 @@ class Generation:
     simulations_path: str
     train_path: str
     network_path_pt: str
+    network_path_onnx: str
     finished_path: str
     settings_path: str
 
     @classmethod
+    @functools.lru_cache(maxsize=None)
     def from_gi(cls, settings: 'LoopSettings', gi: int):
         simulations_path = os.path.join(settings.selfplay_path, f"games_{gi}")
         train_path = os.path.join(settings.training_path, f"gen_{gi}")
@@ -361,10 +451,25 @@ class Generation:
             simulations_path=simulations_path,
             train_path=train_path,
             network_path_pt=os.path.join(train_path, "network.pt"),
+            network_path_onnx=os.path.join(train_path, "network_" if settings.muzero else "network.onnx"),
             finished_path=os.path.join(train_path, "finished.txt"),
             settings_path=os.path.join(train_path, "settings.json"),
         )
 
+    @property
+    def network_paths_onnx(self) -> List[str]:
+        if self.settings.muzero:
+            return [self.network_path_onnx + suffix for suffix in MUZERO_ONNX_SUFFIXES]
+        else:
+            return [self.network_path_onnx]
+
+    def hash_onnx_files(self) -> str:
+        datas = []
+        for path in self.network_paths_onnx:
+            with open(path, "rb") as f:
+                datas.append(f.read())
+        return hash_onnx_datas(datas)
+
     @property
     def prev(self):
         if self.gi == 0:
@@ -372,6 +477,13 @@ class Generation:
         return Generation.from_gi(self.settings, self.gi - 1)
 
 
+def hash_onnx_datas(datas: List[bytes]) -> str:
+    sha = hashlib.sha256()
+    for data in datas:
+        sha.update(data)
+    return sha.hexdigest()
+
+
 class LoopBuffer:
     def __init__(self, game: Game, target_positions: int, test_fraction: float):
         self.game = game
@@ -380,7 +492,10 @@ class LoopBuffer:
 
         self.position_count = 0
         self.simulation_count = 0
-        self.files: List[DataFile] = []
+        self.files: Deque[DataFile] = deque()
+
+        # samplers are kept alive across generations and only get their group updated
+        self._samplers: Dict[Tuple[bool, bool], PositionSampler] = {}
 
     def append(self, logger: Optional[Logger], file: DataFile):
         assert file.info.game == self.game, f"Expected game {self.game.name}, got game {file.info.game.name}"
@@ -390,12 +505,12 @@ class LoopBuffer:
         self.simulation_count += file.info.simulation_count
 
         while self.position_count - len(self.files[0].positions) > self.target_positions:
-            old_file = self.files[0]
-            del self.files[0]
+            old_file = self.files.popleft()
 
             self.position_count -= len(old_file.positions)
             self.simulation_count -= old_file.info.simulation_count
-            old_file.close()
+            # don't close the file, sampler threads share its mapping and can still be reading from it,
+            #   it's unmapped once the last group using it is gone
 
         if logger:
             logger.log("buffer", "gens", len(self.files))
@@ -418,7 +533,7 @@ class LoopBuffer:
     def sampler(
             self,
             batch_size: int, unroll_steps: Optional[int], include_final: bool, random_symmetries: bool,
-            only_last_gen: bool, test: bool
+            processes: int, only_last_gen: bool, test: bool
     ):
         files = [self.files[-1]] if only_last_gen else self.files
 
@@ -429,9 +544,15 @@ class LoopBuffer:
             range_min = 0.0
             range_max = 1 - self.test_fraction
 
-        group = DataGroup.from_files(self.game, files, range_min, range_max)
+        group = DataGroup.from_files(self.game, list(files), range_min, range_max)
+
+        key = (only_last_gen, test)
+        sampler = self._samplers.get(key)
+        if sampler is not None:
+            sampler.update_group(group)
+            return sampler
 
-        return PositionSampler(
+        sampler = PositionSampler(
             group,
             batch_size,
             unroll_steps=unroll_steps,
@@ -439,4 +560,15 @@ class LoopBuffer:
             include_final_for_each=False,
             random_symmetries=random_symmetries,
             threads=1,
+            processes=processes,
         )
+        self._samplers[key] = sampler
+        return sampler
+
+    def close(self):
+        for sampler in self._samplers.values():
+            sampler.close()
+        self._samplers.clear()
+
+        for file in self.files:
+            file.close()
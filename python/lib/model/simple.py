@@ -1,7 +1,8 @@
+import math
+
 from torch import nn
 
 from lib.games import Game
-from lib.util import prod
 
 
 class DenseNetwork(nn.Module):
@@ -13,7 +14,7 @@ class DenseNetwork(nn.Module):
 
         layers = [
             nn.Flatten(),
-            nn.Linear(prod(game.full_input_shape), size),
+            nn.Linear(math.prod(game.full_input_shape), size),
             *[DenseBlock(size, res) for _ in range(depth)],
             nn.BatchNorm1d(size),
             nn.ReLU(),
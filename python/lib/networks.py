@@ -1,5 +1,6 @@
 from typing import Optional
 
+import torch
 from torch import nn
 
 
@@ -20,3 +21,23 @@ class MuZeroNetworks(nn.Module):
         self.representation = representation
         self.dynamics = dynamics
         self.prediction = prediction
+
+
+def compile_network(network: nn.Module, **kwargs) -> nn.Module:
+    # muzero networks are never called as a whole, so compile each of the subnetworks separately instead
+    if isinstance(network, MuZeroNetworks):
+        return MuZeroNetworks(
+            state_channels=network.state_channels,
+            state_quant_bits=network.state_quant_bits,
+            state_channels_saved=network.state_channels_saved,
+            representation=torch.compile(network.representation, **kwargs),
+            dynamics=torch.compile(network.dynamics, **kwargs),
+            prediction=torch.compile(network.prediction, **kwargs),
+        )
+    else:
+        return torch.compile(network, **kwargs)
+
+
+def uncompiled(module: nn.Module) -> nn.Module:
+    # for forward passes with a varying batch size, these would otherwise compile a new graph for each size
+    return getattr(module, "_orig_mod", module)
@@ -1,3 +1,4 @@
+import io
 import json
 import os.path
 import warnings
@@ -11,8 +12,14 @@ from lib.games import Game
 from lib.networks import MuZeroNetworks
 from lib.util import guess_module_device
 
+# the files written by save_muzero_onnx, relative to path_base
+MUZERO_ONNX_SUFFIXES = ["info.json", "representation.onnx", "dynamics.onnx", "prediction.onnx"]
 
-def save_muzero_onnx(game: Game, path_base: str, networks: MuZeroNetworks, check_batch_size: Optional[int]):
+
+def save_muzero_onnx(
+        game: Game, path_base: str, networks: MuZeroNetworks, check_batch_size: Optional[int]
+) -> List[bytes]:
+    """ Returns the contents of the written files, in the order of `MUZERO_ONNX_SUFFIXES`. """
     assert path_base.endswith("_"), f"Path must end with '_', got '{path_base}'"
 
     state_shape = (networks.state_channels, game.board_size, game.board_size)
@@ -27,10 +34,11 @@ def save_muzero_onnx(game: Game, path_base: str, networks: MuZeroNetworks, check
         "state_channels_saved": networks.state_channels_saved,
         "state_quant_bits": networks.state_quant_bits,
     }
-    with open(info_path, "w") as f:
-        json.dump(info, f)
+    info_bytes = json.dumps(info).encode()
+    with open(info_path, "wb") as f:
+        f.write(info_bytes)
 
-    save_onnx_inner(
+    representation_bytes = save_onnx_inner(
         path_base + "representation.onnx",
         networks.representation,
         [game.full_input_shape],
@@ -38,7 +46,7 @@ def save_muzero_onnx(game: Game, path_base: str, networks: MuZeroNetworks, check
         check_batch_size
     )
 
-    save_onnx_inner(
+    dynamics_bytes = save_onnx_inner(
         path_base + "dynamics.onnx",
         networks.dynamics,
         [state_limit_shape, game.input_mv_shape],
@@ -47,7 +55,7 @@ def save_muzero_onnx(game: Game, path_base: str, networks: MuZeroNetworks, check
         check_batch_size
     )
 
-    save_onnx_inner(
+    prediction_bytes = save_onnx_inner(
         path_base + "prediction.onnx",
         networks.prediction,
         [state_shape],
@@ -56,9 +64,11 @@ def save_muzero_onnx(game: Game, path_base: str, networks: MuZeroNetworks, check
         check_batch_size
     )
 
+    return [info_bytes, representation_bytes, dynamics_bytes, prediction_bytes]
+
 
-def save_onnx(game: Game, path_onnx: str, network: nn.Module, check_batch_size: Optional[int]):
-    save_onnx_inner(
+def save_onnx(game: Game, path_onnx: str, network: nn.Module, check_batch_size: Optional[int]) -> bytes:
+    return save_onnx_inner(
         path_onnx,
         network, [game.full_input_shape],
         ["input"], ["scalars", "policy"],
@@ -71,7 +81,8 @@ def save_onnx_inner(
         network: nn.Module, input_shapes,
         input_names: List[str], output_names: List[str],
         check_batch_size: Optional[int]
-):
+) -> bytes:
+    """ Export the network to `path_onnx` and return the written bytes. """
     path_onnx = Path(path_onnx)
     assert path_onnx.suffix == ".onnx", f"Output path should end with .onnx: '{path_onnx}'"
     assert not path_onnx.exists(), f"Output path already exists: '{path_onnx}'"
@@ -106,12 +117,15 @@ def save_onnx_inner(
 
     batch_axis = {0: "batch_size"}
 
+    # export into memory first so the file is written in a single call and the caller can reuse the bytes
+    buffer = io.BytesIO()
+
     with warnings.catch_warnings():
         warnings.filterwarnings("ignore", message="Model has no forward function")
         torch.onnx.export(
             model=network,
             args=tuple(check_inputs),
-            f=path_onnx,
+            f=buffer,
             input_names=input_names,
             output_names=output_names,
             dynamic_axes={k: batch_axis for k in input_names + output_names},
@@ -121,6 +135,25 @@ def save_onnx_inner(
     # move the network back to the original device
     network.to(guessed_device)
 
+    write_file_chunked(path_onnx, buffer.getbuffer())
+
+    return buffer.getvalue()
+
+
+WRITE_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def write_file_chunked(path, data: memoryview):
+    """ Write `data` to `path` with raw `os.write` calls of `WRITE_CHUNK_SIZE`, bypassing python's small IO buffer. """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        data = memoryview(data).cast("B")
+        offset = 0
+        while offset < len(data):
+            offset += os.write(fd, data[offset:offset + WRITE_CHUNK_SIZE])
+    finally:
+        os.close(fd)
+
 
 # Based on https://github.com/microsoft/onnxruntime/blob/master/tools/python/remove_initializer_from_input.py
 def remove_initializers_from_input(model):
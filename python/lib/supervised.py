@@ -15,7 +15,7 @@ from lib.plotter import LogPlotter
 from lib.save_onnx import save_onnx
 from lib.schedule import Schedule
 from lib.train import TrainSettings
-from lib.util import json_map
+from lib.util import json_map, save_module_atomic
 
 
 def supervised_loop(
@@ -29,6 +29,9 @@ def supervised_loop(
     with open(os.path.join(output_folder, f"settings_{start_bi}.json"), "w") as settings_f:
         json.dump(settings, settings_f, default=json_map, indent=2)
 
+    # the scripted module shares its parameters with the network, so it only has to be scripted once
+    scripted_network = torch.jit.script(network)
+
     prev_start = time.perf_counter()
 
     for bi in itertools.count(start_bi):
@@ -55,11 +58,13 @@ def supervised_loop(
         if bi % test_steps == 0:
             network.eval()
 
-            train_batch = train_sampler.next_batch()
-            settings.evaluate_batch(network, train_batch, "test-train", logger)
+            # no autograd graph is needed for the test batches
+            with torch.inference_mode():
+                train_batch = train_sampler.next_batch()
+                settings.evaluate_batch(network, train_batch, "test-train", logger)
 
-            test_batch = test_sampler.next_batch()
-            settings.evaluate_batch(network, test_batch, "test-test", logger)
+                test_batch = test_sampler.next_batch()
+                settings.evaluate_batch(network, test_batch, "test-test", logger)
 
             # compare to just predicting the mean value
             train_batch_wdl = settings.scalar_target.pick(final=train_batch.wdl_final, zero=train_batch.wdl_zero)
@@ -80,8 +85,8 @@ def supervised_loop(
 
         if bi % save_steps == 0:
             print("Saving log")
-            logger.save(os.path.join(output_folder, "log.npz"))
+            logger.save(os.path.join(output_folder, "log.npy"))
 
             print("Saving network")
-            torch.jit.script(network).save(os.path.join(output_folder, f"network_{bi}.pt"))
+            save_module_atomic(scripted_network, os.path.join(output_folder, f"network_{bi}.pt"))
             save_onnx(settings.game, os.path.join(output_folder, f"network_{bi}.onnx"), network, 4)
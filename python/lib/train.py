@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import Union
+from typing import Union, List
 
 import numpy as np
 import torch
@@ -11,7 +11,7 @@ from torch.optim import Optimizer
 from lib.data.position import PositionBatch, UnrolledPositionBatch
 from lib.games import Game
 from lib.logger import Logger
-from lib.networks import MuZeroNetworks
+from lib.networks import MuZeroNetworks, uncompiled
 from lib.util import calc_gradient_norms, calc_parameter_norm, fake_quantize_scale, DEVICE
 
 
@@ -56,6 +56,12 @@ class TrainSettings:
 
     mask_policy: bool
 
+    # run the forward passes in bfloat16 autocast, only used on cuda
+    mixed_precision: bool
+    # run the muzero prediction (and similarity) passes once for all unroll steps,
+    #   faster but the batch norm statistics are shared between steps
+    batch_unrolled_heads: bool
+
     def train_step(
             self,
             batch: EitherBatch,
@@ -84,12 +90,15 @@ class TrainSettings:
         logger.log("param_norm", "param_norm", calc_parameter_norm(network))
 
     def evaluate_either_batch(self, batch: EitherBatch, network: EitherNetwork, logger: Logger, log_prefix: str):
-        if isinstance(batch, UnrolledPositionBatch):
-            loss = self.evaluate_batch_unrolled(network, batch, log_prefix, logger)
-        elif isinstance(batch, PositionBatch):
-            loss = self.evaluate_batch(network, batch, log_prefix, logger)
-        else:
-            assert False, f"Unexpected batch type {type(batch)}"
+        use_autocast = self.mixed_precision and DEVICE.type == "cuda"
+
+        with torch.autocast(device_type=DEVICE.type, dtype=torch.bfloat16, enabled=use_autocast):
+            if isinstance(batch, UnrolledPositionBatch):
+                loss = self.evaluate_batch_unrolled(network, batch, log_prefix, logger)
+            elif isinstance(batch, PositionBatch):
+                loss = self.evaluate_batch(network, batch, log_prefix, logger)
+            else:
+                assert False, f"Unexpected batch type {type(batch)}"
         return loss
 
     def evaluate_batch(self, network: nn.Module, batch: PositionBatch, log_prefix: str, logger: Logger):
@@ -105,6 +114,9 @@ class TrainSettings:
         total_loss = torch.zeros((), device=DEVICE)
         curr_state = None
 
+        # the unsaved states, only collected if the heads are batched
+        states = []
+
         for k, step in enumerate(batch.positions):
             step_prefix = f"{log_prefix}/f{k}"
 
@@ -114,29 +126,31 @@ class TrainSettings:
                 prev_position = batch.positions[k - 1]
                 curr_state = networks.dynamics(curr_state, prev_position.played_mv_full)
 
-                if self.sim_weight != 0.0:
+                if self.sim_weight != 0.0 and not self.batch_unrolled_heads:
                     # TODO it's kind of annoying that we don't have the same batch size here each time,
                     #   but otherwise we mess up eg. batch-norm with nan or dummy inputs
                     with torch.no_grad():
-                        curr_state_repr = networks.representation(step.input_full[~step.is_post_final])
+                        curr_state_repr = uncompiled(networks.representation)(step.input_full[~step.is_post_final])
                     total_loss += self.eval_similarity(
                         curr_state, curr_state_repr, step.is_post_final,
                         logger, step_prefix
                     )
 
-            scalars_k, policy_logits_k = networks.prediction(curr_state)
+            if self.batch_unrolled_heads:
+                states.append(curr_state)
+            else:
+                scalars_k, policy_logits_k = networks.prediction(curr_state)
+                total_loss += self.evaluate_batch_predictions(
+                    step_prefix, logger, True,
+                    batch.positions[k], scalars_k, policy_logits_k
+                )
 
             # limit the number of channels that have to be saved
             curr_state = curr_state[:, :networks.state_channels_saved, :, :]
 
             # quantize to reduce memory usage in inference, but only _after_ policy and value heads
             if networks.state_quant_bits is not None:
-                curr_state = fake_quantize_scale(curr_state, 1.0, networks.state_quant_bits)
-
-            total_loss += self.evaluate_batch_predictions(
-                step_prefix, logger, True,
-                batch.positions[k], scalars_k, policy_logits_k
-            )
+                curr_state = fake_quantize_scale(curr_state.float(), 1.0, networks.state_quant_bits)
 
             # TODO is a BN layer inside of the networks enough for hidden state normalization?
             std, mean = torch.std_mean(curr_state.flatten(1), dim=1)
@@ -147,9 +161,49 @@ class TrainSettings:
             #   maybe this is more important when working with SGD?
             # curr_state = scale_gradient(curr_state, 0.5)
 
+        if self.batch_unrolled_heads:
+            total_loss += self.evaluate_heads_batched(networks, batch, states, log_prefix, logger)
+
         norm_loss = total_loss / len(batch.positions)
         return norm_loss
 
+    def evaluate_heads_batched(
+            self,
+            networks: MuZeroNetworks, batch: UnrolledPositionBatch, states: List[torch.Tensor],
+            log_prefix: str, logger: Logger
+    ):
+        # in train mode this changes the batch norm statistics, they're now shared between all steps
+        total_loss = torch.zeros((), device=DEVICE)
+
+        if self.sim_weight != 0.0 and len(batch.positions) > 1:
+            later_steps = batch.positions[1:]
+
+            with torch.no_grad():
+                states_repr = uncompiled(networks.representation)(torch.cat([
+                    step.input_full[~step.is_post_final] for step in later_steps
+                ]))
+            counts = torch.stack([(~step.is_post_final).sum() for step in later_steps]).tolist()
+
+            for k, (step, state_repr) in enumerate(zip(later_steps, torch.split(states_repr, counts)), start=1):
+                total_loss += self.eval_similarity(
+                    states[k], state_repr, step.is_post_final,
+                    logger, f"{log_prefix}/f{k}"
+                )
+
+        scalars, policy_logits = networks.prediction(torch.cat(states))
+        step_count = len(batch.positions)
+
+        scalars_split = scalars.chunk(step_count)
+        policy_logits_split = policy_logits.chunk(step_count)
+
+        for k, (scalars_k, policy_logits_k) in enumerate(zip(scalars_split, policy_logits_split)):
+            total_loss += self.evaluate_batch_predictions(
+                f"{log_prefix}/f{k}", logger, True,
+                batch.positions[k], scalars_k, policy_logits_k
+            )
+
+        return total_loss
+
     def eval_similarity(self, curr_state, curr_state_repr_filtered, is_post_final, logger: Logger, log_prefix: str):
         batch_size = len(is_post_final)
         non_post_final_count = len(curr_state_repr_filtered)
@@ -173,6 +227,10 @@ class TrainSettings:
     ):
         """Returns the total loss for the given batch while logging a bunch of statistics"""
 
+        # the losses are always calculated in full precision, even if the network ran in mixed precision
+        scalars = scalars.float()
+        policy_logits = policy_logits.float()
+
         value = torch.tanh(scalars[:, 0])
         wdl_logits = scalars[:, 1:4]
         wdl = nnf.softmax(wdl_logits, -1)
@@ -8,38 +8,66 @@ import numpy as np
 import torch
 from torch import nn
 
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-PIN_MEMORY = False
-
-
-def prod(values):
-    result = 1
-    for v in values:
-        result *= v
-    return result
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+PIN_MEMORY = torch.cuda.is_available()
 
 
 def print_param_count(module: nn.Module, ):
-    param_count = sum(prod(p.shape) for p in module.parameters())
+    param_count = sum(p.numel() for p in module.parameters())
     print(f"Model has {param_count} parameters, which takes {4 * param_count // 1024 / 1024:.3f} Mb")
 
     for name, child in module.named_children():
-        child_param_count = sum(prod(p.shape) for p in child.parameters())
+        child_param_count = sum(p.numel() for p in child.parameters())
         print(f"  {name}: {child_param_count / param_count:.2f}")
 
 
-def calc_gradient_norms(module: nn.Module):
-    norms = []
+def enable_tensor_cores(cudnn_benchmark: bool):
+    # allow tensor cores for the remaining float32 matmuls and convolutions
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    # only pays off if the batch shapes are fixed, otherwise the conv algorithms are benchmarked again for every shape
+    torch.backends.cudnn.benchmark = cudnn_benchmark
+
 
+def to_channels_last(module: nn.Module):
+    # lets cudnn use the tensor core conv kernels without transposing
+    module.to(memory_format=torch.channels_last)
+
+
+def pack_parameters(module: nn.Module):
+    # move all parameters into a single buffer per device and dtype, call after layout changes and before the optimizer
+    groups = {}
     for param in module.parameters():
-        if param.grad is not None:
-            norms.append((param.grad.detach() ** 2).mean().item())
+        groups.setdefault((param.device, param.dtype), []).append(param)
+
+    for (device, dtype), params in groups.items():
+        buffer = torch.empty(sum(p.numel() for p in params), device=device, dtype=dtype)
 
-    return np.array(norms)
+        offset = 0
+        for param in params:
+            assert param.is_contiguous() or param.is_contiguous(memory_format=torch.channels_last), \
+                "Parameters must be densely packed"
+            view = buffer.as_strided(param.shape, param.stride(), offset)
+            view.copy_(param.data)
+            param.data = view
+            offset += param.numel()
+
+
+def calc_gradient_norms(module: nn.Module):
+    """ The mean squared gradient for each parameter, calculated with a single device sync. """
+    grads = [param.grad.detach() for param in module.parameters() if param.grad is not None]
+    if len(grads) == 0:
+        return np.array([])
+
+    norms = torch.stack(torch._foreach_norm(grads, 2))
+    numels = torch.tensor([g.numel() for g in grads], device=norms.device)
+
+    return (norms ** 2 / numels).cpu().numpy()
 
 
 def calc_parameter_norm(module: nn.Module):
-    return sum(param.detach().norm(p=2) for param in module.parameters()).item()
+    params = [param.detach() for param in module.parameters()]
+    return torch.stack(torch._foreach_norm(params, 2)).sum().item()
 
 
 def guess_module_device(model: nn.Module) -> str:
@@ -70,6 +98,13 @@ def fake_quantize_scale(x, scale: float, bits: int):
     )
 
 
+def save_module_atomic(module: torch.jit.ScriptModule, path: str):
+    """ Save to a temporary file first, so `path` never contains a partially written module. """
+    tmp_path = path + ".tmp"
+    torch.jit.save(module, tmp_path)
+    os.replace(tmp_path, path)
+
+
 def clean_folder(path):
     if os.path.exists(path):
         shutil.rmtree(path)
@@ -9,9 +9,12 @@ from lib.loop import FixedSelfplaySettings, LoopSettings
 from lib.model.post_act import PredictionHeads, ResTower, ScalarHead, ConvPolicyHead
 from lib.selfplay_client import SelfplaySettings, UctWeights
 from lib.train import TrainSettings, ScalarTarget
+from lib.util import DEVICE, enable_tensor_cores
 
 
 def main():
+    enable_tensor_cores(cudnn_benchmark=False)
+
     game = Game.find("go-9")
 
     fixed_settings = FixedSelfplaySettings(
@@ -63,6 +66,8 @@ def main():
         scalar_target=ScalarTarget.Final,
         train_in_eval_mode=False,
         mask_policy=True,
+        mixed_precision=True,
+        batch_unrolled_heads=False,
     )
 
     def build_network(depth: int, channels: int):
@@ -86,7 +91,7 @@ def main():
 
         dummy_network=None,
         initial_network=initial_network,
-        initial_data_files=[DataFile.open(game, path) for path in glob.glob(initial_files_pattern)],
+        initial_data_files=DataFile.open_many(game, glob.glob(initial_files_pattern)),
 
         only_generate=False,
 
@@ -97,7 +102,7 @@ def main():
         samples_per_position=0.3,
         test_fraction=0.05,
 
-        optimizer=lambda params: AdamW(params, weight_decay=1e-3),
+        optimizer=lambda params: AdamW(params, weight_decay=1e-3, fused=DEVICE.type == "cuda"),
 
         fixed_settings=fixed_settings,
         selfplay_settings=selfplay_settings,
@@ -107,6 +112,10 @@ def main():
         # TODO should alphazero training include the final position?
         sample_include_final=False,
         sample_random_symmetries=True,
+        # workers are spawned on windows, each one would re-import torch and set up its own cuda context
+        sample_processes=0 if sys.platform == "win32" else 4,
+
+        compile_network=sys.platform != "win32",
     )
 
     settings.calc_batch_count_per_gen(game.estimate_moves_per_game, do_print=True)
@@ -13,9 +13,12 @@ from lib.model.post_act import ScalarHead, PredictionHeads, ResTower, ConcatInpu
 from lib.networks import MuZeroNetworks
 from lib.selfplay_client import SelfplaySettings, UctWeights
 from lib.train import TrainSettings, ScalarTarget
+from lib.util import DEVICE, enable_tensor_cores
 
 
 def main():
+    enable_tensor_cores(cudnn_benchmark=False)
+
     game = Game.find("ttt")
 
     saved_state_channels = 32
@@ -69,6 +72,8 @@ def main():
         scalar_target=ScalarTarget.Final,
         train_in_eval_mode=False,
         mask_policy=False,
+        mixed_precision=True,
+        batch_unrolled_heads=False,
     )
 
     def build_network(depth: int, channels: int):
@@ -115,7 +120,7 @@ def main():
 
         dummy_network=None,
         initial_network=initial_network,
-        initial_data_files=[DataFile.open(game, path) for path in glob.glob(initial_files_pattern)],
+        initial_data_files=DataFile.open_many(game, glob.glob(initial_files_pattern)),
 
         only_generate=False,
 
@@ -126,7 +131,7 @@ def main():
         samples_per_position=10,
         test_fraction=0.05,
 
-        optimizer=lambda params: AdamW(params, weight_decay=1e-3),
+        optimizer=lambda params: AdamW(params, weight_decay=1e-3, fused=DEVICE.type == "cuda"),
 
         fixed_settings=fixed_settings,
         selfplay_settings=selfplay_settings,
@@ -135,6 +140,10 @@ def main():
         sample_muzero_steps=5,
         sample_include_final=True,
         sample_random_symmetries=False,
+        # workers are spawned on windows, each one would re-import torch and set up its own cuda context
+        sample_processes=0 if sys.platform == "win32" else 4,
+
+        compile_network=sys.platform != "win32",
     )
 
     # settings.calc_batch_count_per_gen()
@@ -1,5 +1,6 @@
 import os
 import re
+import sys
 from typing import Optional
 
 import torch
@@ -14,7 +15,7 @@ from lib.model.post_act import ScalarHead, AttentionPolicyHead, PredictionHeads
 from lib.plotter import LogPlotter, run_with_plotter
 from lib.supervised import supervised_loop
 from lib.train import TrainSettings, ScalarTarget
-from lib.util import DEVICE, print_param_count
+from lib.util import DEVICE, print_param_count, enable_tensor_cores, to_channels_last
 
 
 def find_last_finished_batch(path: str) -> Optional[int]:
@@ -31,6 +32,8 @@ def find_last_finished_batch(path: str) -> Optional[int]:
 
 
 def main(plotter: LogPlotter):
+    enable_tensor_cores(cudnn_benchmark=True)
+
     output_folder = "../../data/supervised/att-again-deeper"
 
     paths = [
@@ -63,6 +66,8 @@ def main(plotter: LogPlotter):
         scalar_target=ScalarTarget.Final,
         train_in_eval_mode=False,
         mask_policy=True,
+        mixed_precision=True,
+        batch_unrolled_heads=False,
     )
     include_final: bool = False
 
@@ -76,15 +81,18 @@ def main(plotter: LogPlotter):
             policy_head=AttentionPolicyHead(game, channels, channels),
         )
 
-    files = sorted((DataFile.open(game, p) for p in paths), key=lambda f: f.info.timestamp)
+    files = sorted(DataFile.open_many(game, paths), key=lambda f: f.info.timestamp)
     if limit_file_count is not None:
         files = files[-min(limit_file_count, len(files)):]
 
     train_group = DataGroup.from_files(game, files, 0, 1 - test_fraction)
     test_group = DataGroup.from_files(game, files, 1 - test_fraction, 1)
 
+    # sampling is mostly python code, so the train batches are collected in worker processes to get around the GIL
+    #   (except on windows, where the workers are spawned and each one would set up its own cuda context)
     train_sampler = PositionSampler(train_group, batch_size, None, include_final, False, train_random_symmetries,
-                                    threads=1)
+                                    threads=1, processes=0 if sys.platform == "win32" else 4)
+    # the test sampler is only used once every test_steps batches
     test_sampler = PositionSampler(test_group, batch_size, None, include_final, False, train_random_symmetries,
                                    threads=1)
 
@@ -99,21 +107,22 @@ def main(plotter: LogPlotter):
     if last_bi is None:
         logger = Logger()
         start_bi = 0
-        network = initial_network()
+        with torch.device(DEVICE):
+            network = initial_network()
     else:
         assert allow_resume, f"Not allowed to resume, but found existing batch {last_bi}"
 
-        logger = Logger.load(os.path.join(output_folder, "log.npz"))
+        logger = Logger.load(os.path.join(output_folder, "log.npy"))
         start_bi = last_bi + 1
-        network = torch.jit.load(os.path.join(output_folder, f"network_{last_bi}.pt"))
+        network = torch.jit.load(os.path.join(output_folder, f"network_{last_bi}.pt"), map_location=DEVICE)
 
-    network.to(DEVICE)
+    to_channels_last(network)
     print_param_count(network)
 
     # optimizer = SGD(network.parameters(), weight_decay=1e-5, lr=0.0, momentum=0.9)
     # schedule = WarmupSchedule(100, FixedSchedule([0.02, 0.01, 0.001], [900, 2_000]))
 
-    optimizer = torch.optim.AdamW(network.parameters(), weight_decay=1e-5)
+    optimizer = torch.optim.AdamW(network.parameters(), weight_decay=1e-5, fused=DEVICE.type == "cuda")
     schedule = None
 
     plotter.set_title(f"supervised {output_folder}")
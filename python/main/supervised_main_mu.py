@@ -1,5 +1,9 @@
+import copy
 import itertools
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Optional
 
 import torch.jit
 from torch import nn
@@ -11,16 +15,19 @@ from lib.data.sampler import PositionSampler
 from lib.games import Game
 from lib.logger import Logger
 from lib.model.layers import Flip
-from lib.model.post_act import ResTower, ConcatInputsChannelwise, PredictionHeads, ScalarHead, DensePolicyHead
-from lib.networks import MuZeroNetworks
+from lib.model.post_act import ResTower, ConcatInputsChannelwise, PredictionHeads, ScalarHead, DensePolicyHead, \
+    ResBlock
+from lib.networks import MuZeroNetworks, compile_network
 from lib.plotter import run_with_plotter, LogPlotter
 from lib.train import TrainSettings, ScalarTarget
-from lib.util import DEVICE
+from lib.util import DEVICE, save_module_atomic, pack_parameters, enable_tensor_cores, to_channels_last
 
 
 def main(plotter: LogPlotter):
     print(f"Using device {DEVICE}")
 
+    enable_tensor_cores(cudnn_benchmark=True)
+
     game = Game.find("chess")
 
     paths = [
@@ -28,7 +35,7 @@ def main(plotter: LogPlotter):
         for gi in range(800, 1200)
     ]
 
-    files = [DataFile.open(game, p) for p in paths]
+    files = DataFile.open_many(game, paths)
     group = DataGroup.from_files(game, files)
     sampler = PositionSampler(
         group,
@@ -37,7 +44,10 @@ def main(plotter: LogPlotter):
         include_final=True,
         include_final_for_each=False,
         random_symmetries=False,
+        # sampling is mostly python code, so collect the batches in worker processes to get around the GIL
+        #   (except on windows, where the workers are spawned and each one would set up its own cuda context)
         threads=1,
+        processes=0 if sys.platform == "win32" else 4,
     )
 
     train = TrainSettings(
@@ -52,10 +62,19 @@ def main(plotter: LogPlotter):
         scalar_target=ScalarTarget.Final,
         train_in_eval_mode=False,
         mask_policy=False,
+        mixed_precision=True,
+        batch_unrolled_heads=False,
     )
 
-    output_path = "../../data/muzero/restart-sim"
-    os.makedirs(output_path, exist_ok=False)
+    # there is no resume support, so a rerun goes into a fresh folder instead of overwriting the previous one
+    output_base = "../../data/muzero/restart-sim"
+    output_path = output_base
+    for ri in itertools.count(1):
+        if not os.path.exists(output_path):
+            break
+        output_path = f"{output_base}_{ri}"
+    os.makedirs(output_path)
+    print(f"Writing output to {output_path}")
 
     channels = 128
     depth = 16
@@ -76,7 +95,7 @@ def main(plotter: LogPlotter):
         Flip(dim=2),
     ))
     prediction = PredictionHeads(
-        common=ResTower(depth, saved_channels, channels, final_affine=True),
+        common=ResBlock(channels),
         scalar_head=ScalarHead(game.board_size, channels, 8, 128),
         policy_head=DensePolicyHead(game, channels, 32, None)
     )
@@ -90,25 +109,47 @@ def main(plotter: LogPlotter):
         prediction=prediction,
     )
     networks.to(DEVICE)
+    to_channels_last(networks)
+    # keep all weights in one slab, so the towers don't end up scattered through device memory
+    pack_parameters(networks)
+
+    # script once for saving, training goes through compiled subnetworks that are replayed as cuda graphs,
+    #   all of these share the same parameters
+    scripted_networks = torch.jit.script(networks)
+    #   max-autotune additionally benchmarks fused triton kernels against cudnn, worth it for the fixed shapes here
+    #   (the variable size similarity pass runs uncompiled, so every compiled call has a single static shape)
+    compile_mode = "max-autotune" if DEVICE.type == "cuda" else "default"
+    train_networks = compile_network(networks, mode=compile_mode, dynamic=False)
 
     logger = Logger()
-    optimizer = AdamW(networks.parameters(), weight_decay=1e-5)
+    optimizer = AdamW(networks.parameters(), weight_decay=1e-5, fused=DEVICE.type == "cuda")
 
     plotter.set_can_pause(True)
 
+    # checkpoints are written in the background while training continues
+    save_executor = ThreadPoolExecutor(max_workers=1)
+    pending_save: Optional[Future] = None
+
     print("Start training")
     for bi in itertools.count():
         if bi % 100 == 0:
-            logger.save(f"{output_path}/log.npz")
+            logger.save(f"{output_path}/log.npy")
         if bi % 500 == 0:
-            torch.jit.save(torch.jit.script(networks), f"{output_path}/models_{bi}.pb")
+            if pending_save is not None:
+                pending_save.result()
+
+            # save a snapshot, the training steps would otherwise modify the weights while they're being written
+            snapshot = copy.deepcopy(scripted_networks)
+            pending_save = save_executor.submit(save_module_atomic, snapshot, f"{output_path}/models_{bi}.pb")
 
         plotter.block_while_paused()
-        print(f"bi: {bi}")
+        # printing every batch is a noticeable part of the step time for small networks
+        if bi % 64 == 0:
+            print(f"bi: {bi}")
         logger.start_batch()
 
         batch = sampler.next_unrolled_batch()
-        train.train_step(batch, networks, optimizer, logger)
+        train.train_step(batch, train_networks, optimizer, logger)
 
         plotter.update(logger)
 